@@ -342,27 +342,27 @@ class AnchorGenerator(nn.Module):
 
         anchors_all = []
         for stride, scales, aspect_ratios in zip(self.strides, self.scales, self.aspect_ratios):
-            anchors_level = []
+            if image_size % stride != 0:
+                raise ValueError('input size must be divided by the stride.')
+            # shifts只与stride有关: 每个level只生成一次网格
+            shifts_x = torch.arange(stride / 2, image_size, stride, dtype=dtype, device=device)
+            shifts_y = torch.arange(stride / 2, image_size, stride, dtype=dtype, device=device)
+            shift_y, shift_x = torch.meshgrid(shifts_y, shifts_x)
+            shift_x = shift_x.reshape(-1)
+            shift_y = shift_y.reshape(-1)
+            shifts = torch.stack((shift_x, shift_y, shift_x, shift_y), dim=1)  # (X, 4)
+            # 所有(scale, aspect_ratio)的偏移. shape(A, 4)
+            offsets = []
             for scale in scales:
                 for aspect_ratio in aspect_ratios:
-                    if image_size % stride != 0:
-                        raise ValueError('input size must be divided by the stride.')
                     base_anchor_size = self.base_scale * stride * scale
                     # anchor_h / anchor_w = aspect_ratio
                     anchor_h = base_anchor_size * aspect_ratio[0]
                     anchor_w = base_anchor_size * aspect_ratio[1]
-                    shifts_x = torch.arange(stride / 2, image_size, stride, dtype=dtype, device=device)
-                    shifts_y = torch.arange(stride / 2, image_size, stride, dtype=dtype, device=device)
-                    shift_y, shift_x = torch.meshgrid(shifts_y, shifts_x)
-                    shift_x = shift_x.reshape(-1)
-                    shift_y = shift_y.reshape(-1)
-                    shifts = torch.stack((shift_x, shift_y, shift_x, shift_y), dim=1)  # (X, 4)
-                    # left, top, right, bottom. shape(X, 4)
-                    anchors = shifts + torch.tensor([-anchor_w / 2, -anchor_h / 2, anchor_w / 2, anchor_h / 2],
-                                                    dtype=dtype, device=device)[None]
-                    anchors_level.append(anchors)
-
-            anchors_level = torch.stack(anchors_level, dim=1).reshape(-1, 4)  # shape(X, A, 4) -> (-1, 4)
+                    offsets.append([-anchor_w / 2, -anchor_h / 2, anchor_w / 2, anchor_h / 2])
+            offsets = torch.tensor(offsets, dtype=dtype, device=device)
+            # left, top, right, bottom. 广播: shape(X, 1, 4) + (1, A, 4) -> (X, A, 4) -> (-1, 4)
+            anchors_level = (shifts[:, None] + offsets[None]).reshape(-1, 4)
             anchors_all.append(anchors_level)
         self.anchors = torch.cat(anchors_all, dim=0)  # shape(-1, 4)
         return self.anchors
@@ -5,35 +5,51 @@
 import torch
 import torch.nn.functional as F
 from torch import Tensor
-from typing import Tuple, List, Union
+from typing import Tuple, List, Union, Optional
+from collections import OrderedDict
+import functools
+import inspect
 import math
 
 
 # --------------------------------------------------- activation
+# 逐元素的激活函数使用torch.jit.script, 使融合器将多个算子合并为一个kernel(x只读一次, y只写一次)
 
+@torch.jit.script
 def _relu(x: Tensor) -> Tensor:
     """(F.relu(inplace=False))
 
     :param x: shape = (*)
     :return: shape = x.shape"""
-    return torch.where(x > 0, x,
-                       torch.tensor(0., dtype=x.dtype, device=x.device))
+    return torch.clamp_min(x, 0.)  # 标量0不需要创建张量
 
 
+@torch.jit.script
 def _leaky_relu(x: Tensor, negative_slope: float = 0.01) -> Tensor:
     """(F.leaky_relu(inplace=False))"""
     return torch.where(x > 0, x, negative_slope * x)
 
 
+@torch.jit.script
 def _sigmoid(x: Tensor) -> Tensor:
     """(F.sigmoid())"""
-    return 1 / (1 + torch.exp(-x))
+    # return 1 / (1 + torch.exp(-x))  # x很小时exp(-x)溢出
+    e = torch.exp(-torch.abs(x))  # 范围(0, 1], 不溢出
+    r = torch.reciprocal(1 + e)
+    return torch.where(x >= 0, r, e * r)
 
 
+@torch.jit.script
 def _tanh(x: Tensor) -> Tensor:
     """(F.tanh())"""
-    return (1 - torch.exp(2 * -x)) / (1 + torch.exp(2 * -x))  # 上下同乘(e^-x)
     # return (torch.exp(x) - torch.exp(-x)) / (torch.exp(x) + torch.exp(-x))
+    # tanh为奇函数, 只对|x|计算. 上下同乘(e^-|x|)
+    e = torch.exp(-2 * torch.abs(x))  # 范围(0, 1], 不溢出
+    y = (1 - e) / (1 + e)
+    return torch.where(x >= 0, y, -y)
+
+
+_L2_CACHE_SIZE = 1024 * 1024  # 字节. 按常见的L2缓存大小估计
 
 
 def _softmax(x: Tensor, dim: int) -> Tensor:
@@ -42,18 +58,83 @@ def _softmax(x: Tensor, dim: int) -> Tensor:
     :param x: shape = (N, In)
     :param dim: int. 一般dim设为-1
     :return: shape = x.shape"""
-    return torch.exp(x) / torch.sum(torch.exp(x), dim, keepdim=True)
+    # 分块只对CPU有意义(GPU的softmax kernel已按行在片上计算); 分块使用原地运算, 不支持autograd
+    if x.device.type == "cpu" and not x.requires_grad and dim in (-1, x.dim() - 1) and x.is_contiguous() and \
+            x.numel() * x.element_size() > _L2_CACHE_SIZE:
+        return _softmax_blocked(x, dim)
+    return _softmax_kernel(x, dim)
+
+
+@torch.jit.script
+def _softmax_kernel(x: Tensor, dim: int) -> Tensor:
+    """_softmax()的计算部分"""
+    x = x - torch.amax(x, dim, keepdim=True)  # 防止exp()溢出. 结果不变
+    x = torch.exp(x)
+    return x / torch.sum(x, dim, keepdim=True)
+
 
+def _softmax_blocked(x: Tensor, dim: int) -> Tensor:
+    """分块的softmax(CPU). x较大时, max, exp + sum, div需从内存读3遍x.
+    沿非归约维分块, 每块大小适配L2缓存, 则每块只从内存读1遍, 后2遍命中缓存.
+    每块直接在output的切片上原地计算, 不产生中间张量
 
-def _silu(x):
+    :param x: shape = (*, In)
+    :param dim: int
+    :return: shape = x.shape"""
+    x = x.movedim(dim, -1)
+    shape = x.shape
+    x = x.reshape(-1, shape[-1])  # shape(*, In)
+    output = torch.empty_like(x)
+    block_size = max(1, _L2_CACHE_SIZE // (x.shape[-1] * x.element_size()))  # 每块的行数
+    for i in range(0, x.shape[0], block_size):
+        x_block, out_block = x[i:i + block_size], output[i:i + block_size]  # 连续的view
+        torch.sub(x_block, torch.amax(x_block, -1, keepdim=True), out=out_block)
+        out_block.exp_()
+        out_block.div_(torch.sum(out_block, -1, keepdim=True))
+    return output.view(shape).movedim(-1, dim)
+
+
+# x = torch.randn(4096, 4096)
+# print(torch.allclose(_softmax(x, -1), F.softmax(x, -1)))
+# import time
+# for _ in range(2):  # 第1次为预热
+#     t = time.time()
+#     y1 = _softmax_kernel(x, -1)
+#     t1 = time.time() - t
+#     t = time.time()
+#     y2 = _softmax_blocked(x, -1)
+#     t2 = time.time() - t
+#     t = time.time()
+#     y3 = F.softmax(x, -1)
+#     t3 = time.time() - t
+# print(t1, t2, t3)
+
+
+@torch.jit.script
+def _silu(x: Tensor) -> Tensor:
     """(F.silu())"""
     return x * torch.sigmoid(x)
 
 
-def _gelu(x):
+@torch.jit.script
+def _gelu(x: Tensor) -> Tensor:
     """(F.gelu())
     https://arxiv.org/pdf/1606.08415.pdf"""
-    return x / 2 * (1 + torch.erf(x / math.sqrt(2)))
+    return x / 2 * (1 + torch.erf(x / math.sqrt(2.)))
+
+
+@torch.jit.script
+def _softplus(x: Tensor, beta: float = 1., threshold: float = 20.) -> Tensor:
+    """(F.softplus()). 1 / beta * log(1 + exp(beta * x)). beta * x > threshold时为线性(同torch)
+
+    :param x: shape = (*)
+    :param beta: float
+    :param threshold: float
+    :return: shape = x.shape"""
+    x_b = beta * x
+    # log(1 + e^z) = max(z, 0) + log(1 + e^-|z|): exp的参数 <= 0, 不溢出; log1p: e^-|z|接近0时更精确
+    y = (torch.clamp_min(x_b, 0.) + torch.log1p(torch.exp(-torch.abs(x_b)))) / beta
+    return torch.where(x_b > threshold, x, y)
 
 
 # --------------------------------------------------- loss
@@ -65,9 +146,10 @@ def _one_hot(x: Tensor, num_classes: int = -1) -> Tensor:
     :param num_classes: int. default: max(x) + 1
     :return: shape = (N, num_classes). torch.long"""
     if num_classes == -1:
-        num_classes = torch.max(x) + 1
+        num_classes = int(torch.max(x)) + 1
     output = torch.zeros(x.shape[0], num_classes, dtype=torch.long, device=x.device)
-    output[range(x.shape[0]), x] = 1
+    # 行索引用device上的arange, 而不是python的range(需在host上逐个转换为张量再拷贝)
+    output[torch.arange(x.shape[0], device=x.device), x] = 1
     return output
 
 
@@ -78,8 +160,10 @@ def _one_hot_2(x: Tensor, num_classes: int = -1) -> Tensor:
     :param num_classes: int. default: max(x) + 1
     :return: shape = (N, num_classes). torch.long"""
     if num_classes == -1:
-        num_classes = torch.max(x) + 1
-    return torch.eye(num_classes, dtype=torch.long, device=x.device)[x]
+        num_classes = int(torch.max(x)) + 1
+    # 不使用torch.eye(num_classes)[x]: 需额外分配(num_classes, num_classes)的单位阵
+    output = torch.zeros((*x.shape, num_classes), dtype=torch.long, device=x.device)
+    return output.scatter_(-1, x[..., None], 1)
 
 
 # import time
@@ -90,10 +174,10 @@ def _one_hot_2(x: Tensor, num_classes: int = -1) -> Tensor:
 # print(time.time() - t)  # 1.6705341339111328
 # t = time.time()
 # _one_hot_2(x)
-# print(time.time() - t)  # 0.07978534698486328
+# print(time.time() - t)
 
 
-def _embedding(x, weight):
+def _embedding(x: Tensor, weight: Tensor) -> Tensor:
     """(F.embedding())
 
     :param x: shape[*]
@@ -110,8 +194,8 @@ def _nll_loss(pred: Tensor, target: Tensor) -> Tensor:
     :param target: shape = (N,) torch.long.
     :return: shape = ()
     """
-    target = _one_hot(target, pred.shape[-1])
-    return torch.mean(torch.sum(-pred * target, dim=-1))
+    # 直接取出target处的值, 无需生成(N, In)的one_hot
+    return -torch.mean(torch.gather(pred, -1, target[:, None]))
 
 
 def _cross_entropy(pred: Tensor, target: Tensor) -> Tensor:
@@ -120,9 +204,10 @@ def _cross_entropy(pred: Tensor, target: Tensor) -> Tensor:
     :param pred: shape = (N, In). 未过softmax
     :param target: shape = (N,) torch.long. 未过ont_hot
     :return: shape = ()"""
-
-    pred = F.log_softmax(pred, dim=-1)
-    return F.nll_loss(pred, target)
+    # log_softmax(x)[t] = x[t] - logsumexp(x). logsumexp内部减max, 不溢出
+    # 只对target处求log_softmax, 不生成(N, In)的log_softmax张量
+    log_z = torch.logsumexp(pred, -1)  # shape(N,)
+    return torch.mean(log_z - torch.gather(pred, -1, target[:, None])[:, 0])
 
 
 def _binary_cross_entropy(pred: Tensor, target: Tensor) -> Tensor:
@@ -133,7 +218,7 @@ def _binary_cross_entropy(pred: Tensor, target: Tensor) -> Tensor:
     :return: shape = ()"""
     # torch.mean(-torch.log(pred) * target + -torch.log(1 - pred) * (1 - target))
     return torch.mean(torch.clamp_max(-torch.log(pred), 100) * target +  # 防止inf
-                      torch.clamp_max(-torch.log(1 - pred), 100) * (1 - target))
+                      torch.clamp_max(-torch.log1p(-pred), 100) * (1 - target))  # log1p: pred接近0时更精确
 
 
 def _binary_cross_entropy_with_logits(pred: Tensor, target: Tensor, pos_weight: Tensor = None) -> Tensor:
@@ -144,8 +229,10 @@ def _binary_cross_entropy_with_logits(pred: Tensor, target: Tensor, pos_weight:
     :param pos_weight: 正样本的权重. shape = () or num_classes. e.g. shape[20]
     :return: shape = ()"""
     pos_weight = 1. if pos_weight is None else pos_weight
-    # F.logsigmoid(- pred)) 即 F.log(1 - F.sigmoid(y_pred))
-    return torch.mean(-F.logsigmoid(pred) * target * pos_weight + -F.logsigmoid(-pred) * (1 - target))
+    # -log(sigmoid(x)) = max(x, 0) - x + log(1 + e^-|x|). 只需1个exp + 1个log1p, 且不溢出
+    # -log(1 - sigmoid(x)) = -log(sigmoid(-x)) = -log(sigmoid(x)) + x
+    neg_log_p = torch.clamp_min(pred, 0) - pred + torch.log1p(torch.exp(-torch.abs(pred)))
+    return torch.mean(neg_log_p * target * pos_weight + (neg_log_p + pred) * (1 - target))
 
 
 # pred = torch.rand(100, 20)
@@ -179,9 +266,83 @@ def _smooth_l1_loss(pred: Tensor, target: Tensor, beta: float = 1.) -> Tensor:
 
 
 # --------------------------------------------------- layers
-def _batch_norm(x: Tensor, running_mean: Tensor, running_var: Tensor, weight: Tensor = None, bias: Tensor = None,
-                training: bool = False, momentum: float = 0.1, eps: float = 1e-5) -> Tensor:
-    """BN(F.batch_norm()). 对NHW做归一化.
+# 一次遍历求均值和方差: torch.var_mean(Welford算法). x只读一次(而非mean, var, var读三次),
+# 且不像E[x^2] - E[x]^2那样在均值较大时有相消误差
+@torch.jit.script
+def _batch_norm_stats(x: Tensor, dim: List[int]) -> Tuple[Tensor, Tensor, Tensor]:
+    """BN训练时的统计量
+
+    :param x: shape = (N, In) or (N, C, H, W)
+    :param dim: 归一化的维度. (0,) or (0, 2, 3)
+    :return: Tuple(mean, var(有偏), var(无偏)). shape = (In,) or (C,)"""
+    m = x.numel() // x.shape[1]  # 每个通道的元素个数
+    var, mean = torch.var_mean(x, dim, unbiased=False)
+    return mean, var, var * (m / (m - 1))  # 无偏估计由有偏估计换算, 无需再遍历一次
+
+
+def _batch_norm_scale_shift(x: Tensor, dim: List[int], running_mean: Tensor, running_var: Tensor,
+                            weight: Optional[Tensor], bias: Optional[Tensor],
+                            training: bool, momentum: float, eps: float) -> Tuple[Tensor, Tensor]:
+    """BN中对x的仿射变换: (x - mean) * rsqrt(var + eps) * weight + bias = x * scale + shift. (torch中源码实现方式)
+    scale, shift只在(C,)上计算, 对x逐元素只需1次乘1次加(addcmul, 一个kernel). 训练时同时更新running_mean, running_var
+
+    :param x: shape = (N, In) or (N, C, H, W)
+    :param dim: 归一化的维度. [0] or [0, 2, 3]
+    :return: Tuple(scale, shift). shape = (In,) or (C,)"""
+    if weight is not None and weight.dtype != x.dtype:  # 防止torch内部隐式类型转换(拷贝)
+        raise ValueError("dtype error: x(%s) != weight(%s)" % (x.dtype, weight.dtype))
+    if training:
+        # mean: 总体 = 估计. shape = (In,) or (C,)
+        # var: 用于标准化, x作为总体; eval_var: 无偏估计, x作为样本
+        mean, var, eval_var = _batch_norm_stats(x, dim)
+        eval_mean = mean
+        running_mean.data = (1 - momentum) * running_mean + momentum * eval_mean
+        running_var.data = (1 - momentum) * running_var + momentum * eval_var  # 无偏估计
+    else:
+        mean = running_mean
+        var = running_var
+    scale = torch.rsqrt(var + eps)
+    if weight is not None:
+        scale = scale * weight
+    shift = -mean * scale
+    if bias is not None:
+        shift = shift + bias
+    return scale, shift
+
+
+def _batch_norm_1d(x: Tensor, running_mean: Tensor, running_var: Tensor,
+                   weight: Optional[Tensor] = None, bias: Optional[Tensor] = None,
+                   training: bool = False, momentum: float = 0.1, eps: float = 1e-5) -> Tensor:
+    """BN1d(F.batch_norm()). 对N做归一化. 参数同_batch_norm()
+
+    :param x: shape = (N, In)
+    :return: shape = x.shape"""
+    scale, shift = _batch_norm_scale_shift(x, [0], running_mean, running_var, weight, bias,
+                                           training, momentum, eps)
+    return torch.addcmul(shift, x, scale)
+
+
+def _batch_norm_2d(x: Tensor, running_mean: Tensor, running_var: Tensor,
+                   weight: Optional[Tensor] = None, bias: Optional[Tensor] = None,
+                   training: bool = False, momentum: float = 0.1, eps: float = 1e-5,
+                   memory_format: torch.memory_format = torch.contiguous_format) -> Tensor:
+    """BN2d(F.batch_norm()). 对NHW做归一化. 参数同_batch_norm()
+
+    :param x: shape = (N, C, H, W)
+    :return: shape = x.shape. 内存布局为memory_format"""
+    x = x.contiguous(memory_format=memory_format)
+    scale, shift = _batch_norm_scale_shift(x, [0, 2, 3], running_mean, running_var, weight, bias,
+                                           training, momentum, eps)
+    # shape(C,) -> (C, 1, 1)
+    return torch.addcmul(shift[:, None, None], x, scale[:, None, None])
+
+
+def _batch_norm(x: Tensor, running_mean: Tensor, running_var: Tensor,
+                weight: Optional[Tensor] = None, bias: Optional[Tensor] = None,
+                training: bool = False, momentum: float = 0.1, eps: float = 1e-5,
+                memory_format: torch.memory_format = torch.contiguous_format) -> Tensor:
+    """BN(F.batch_norm()). 对NHW做归一化. 按x.dim()分派到_batch_norm_1d(), _batch_norm_2d()
+    (形状固定的调用可直接使用后两者, 没有按维度的分支, 便于torch.compile特化)
 
     :param x: shape = (N, In) or (N, C, H, W)
     :param running_mean: shape = (In,) 或 (C,) 下同
@@ -191,34 +352,15 @@ def _batch_norm(x: Tensor, running_mean: Tensor, running_var: Tensor, weight: Te
     :param training:
     :param momentum: 动量实际为 1 - momentum. (同torch)
     :param eps:
-    :return: shape = x.shape"""
-
-    if training:
-        if x.dim() == 2:
-            _dim = (0,)
-        elif x.dim() == 4:
-            _dim = (0, 2, 3)
-        else:
-            raise ValueError("x dim error")
-        mean = eval_mean = torch.mean(x, _dim)  # 总体 = 估计. shape = (In,) or (C,)
-        eval_var = torch.var(x, _dim, unbiased=True)  # 无偏估计, x作为样本
-        var = torch.var(x, _dim, unbiased=False)  # 用于标准化, x作为总体
-        running_mean.data = (1 - momentum) * running_mean + momentum * eval_mean
-        running_var.data = (1 - momentum) * running_var + momentum * eval_var  # 无偏估计
+    :param memory_format: 4D时x的内存布局(逻辑shape不变). 默认torch.contiguous_format(NCHW).
+        torch.channels_last: NHWC, 与channels_last的卷积相连时无需转置(x不是NHWC时需拷贝一次)
+    :return: shape = x.shape. 4D时内存布局为memory_format"""
+    if x.dim() == 2:
+        return _batch_norm_1d(x, running_mean, running_var, weight, bias, training, momentum, eps)
+    elif x.dim() == 4:
+        return _batch_norm_2d(x, running_mean, running_var, weight, bias, training, momentum, eps, memory_format)
     else:
-        mean = running_mean
-        var = running_var
-    # 2D时, mean.shape = (In,)
-    # 4D时, mean.shape = (C, 1, 1)
-    if x.dim() == 4:  # 扩维
-        mean, var = mean[:, None, None], var[:, None, None]
-        weight, bias = weight[:, None, None], bias[:, None, None]
-    return (x - mean) * torch.rsqrt(var + eps) \
-           * (weight if weight is not None else 1.) + (bias if bias is not None else 0.)
-    # or: 以下为torch中源码实现方式
-    # scale = weight * torch.rsqrt(var + eps)
-    # bias = bias - mean * scale
-    # return x * scale + bias
+        raise ValueError("x dim error")
 
 
 # x = torch.rand(2, 20, 7, 7)
@@ -230,7 +372,54 @@ def _batch_norm(x: Tensor, running_mean: Tensor, running_var: Tensor, weight: Te
 # print(_batch_norm(x, running_mean, running_var, weight, bias, True, 0.1, 1e-5))
 
 
-def _layer_norm(x, normalized_shape, weight=None, bias=None, eps=1e-5):
+def _fuse_conv_bn_weights(conv_w: Tensor, conv_b: Tensor, bn_rm: Tensor, bn_rv: Tensor, bn_eps: float,
+                          bn_w: Tensor = None, bn_b: Tensor = None) -> Tuple[Tensor, Tensor]:
+    """将BN(eval)融入其前面的卷积(torch.nn.utils.fuse_conv_bn_weights()). 推理时省去BN对x的一次读写
+    W' = W * scale, b' = (b - mean) * scale + bias. 其中scale = weight / sqrt(var + eps)
+
+    :param conv_w: shape = (Cout, Cin, KH, KW)
+    :param conv_b: shape = (Cout,). 可为None
+    :param bn_rm: running_mean. shape = (Cout,) 下同
+    :param bn_rv: running_var
+    :param bn_eps:
+    :param bn_w:
+    :param bn_b:
+    :return: Tuple(weight: shape[Cout, Cin, KH, KW], bias: shape[Cout])"""
+    scale = torch.rsqrt(bn_rv + bn_eps) * (bn_w if bn_w is not None else 1.)
+    conv_b = conv_b if conv_b is not None else torch.zeros_like(bn_rm)
+    bias = (conv_b - bn_rm) * scale + (bn_b if bn_b is not None else 0.)
+    return conv_w * scale[:, None, None, None], bias
+
+
+def _fuse_linear_bn_weights(linear_w: Tensor, linear_b: Tensor, bn_rm: Tensor, bn_rv: Tensor, bn_eps: float,
+                            bn_w: Tensor = None, bn_b: Tensor = None) -> Tuple[Tensor, Tensor]:
+    """将BN(eval)融入其前面的全连接层. 同_fuse_conv_bn_weights()
+
+    :param linear_w: shape = (Out, In)
+    :param linear_b: shape = (Out,). 可为None
+    :param bn_rm: running_mean. shape = (Out,) 下同
+    :param bn_rv: running_var
+    :param bn_eps:
+    :param bn_w:
+    :param bn_b:
+    :return: Tuple(weight: shape[Out, In], bias: shape[Out])"""
+    scale = torch.rsqrt(bn_rv + bn_eps) * (bn_w if bn_w is not None else 1.)
+    linear_b = linear_b if linear_b is not None else torch.zeros_like(bn_rm)
+    bias = (linear_b - bn_rm) * scale + (bn_b if bn_b is not None else 0.)
+    return linear_w * scale[:, None], bias
+
+
+# x = torch.randn(2, 16, 7, 7)
+# conv_w, conv_b = torch.randn(32, 16, 3, 3), torch.randn(32)
+# running_mean, running_var = torch.rand(32), torch.rand(32)
+# weight, bias = torch.randn(32), torch.randn(32)
+# y1 = F.batch_norm(F.conv2d(x, conv_w, conv_b), running_mean, running_var, weight, bias, False, 0.1, 1e-5)
+# y2 = F.conv2d(x, *_fuse_conv_bn_weights(conv_w, conv_b, running_mean, running_var, 1e-5, weight, bias))
+# print(torch.allclose(y1, y2, atol=1e-4))
+
+
+def _layer_norm(x: Tensor, normalized_shape: Tuple[int, ...], weight: Optional[Tensor] = None,
+                bias: Optional[Tensor] = None, eps: float = 1e-5) -> Tensor:
     """(F.layer_norm()).
 
     :param x: shape = (*, *normalized_shape)
@@ -242,12 +431,14 @@ def _layer_norm(x, normalized_shape, weight=None, bias=None, eps=1e-5):
 
     _dim = list(range(x.dim() - len(normalized_shape), x.dim()))  # 与最后维度对齐
 
-    mean = torch.mean(x, _dim, keepdim=True)  # shape = [*, 后补1]. (keep_dim)
+    # 一次遍历(torch.var_mean). shape = [*, 后补1]. (keep_dim)
     # x作为总体, 无需使用无偏估计. 注: 在BN中计算running_var需要使用无偏估计
-    var = torch.var(x, _dim, unbiased=False, keepdim=True)
+    var, mean = torch.var_mean(x, _dim, unbiased=False, keepdim=True)
 
-    return (x - mean) * torch.rsqrt(var + eps) \
-           * (weight if weight is not None else 1.) + (bias if bias is not None else 0.)
+    x = (x - mean) * torch.rsqrt(var + eps)
+    if weight is not None and bias is not None:
+        return torch.addcmul(bias, x, weight)  # 一个kernel
+    return x * (weight if weight is not None else 1.) + (bias if bias is not None else 0.)
 
 
 # import torch.nn as nn
@@ -261,6 +452,34 @@ def _layer_norm(x, normalized_shape, weight=None, bias=None, eps=1e-5):
 # print(torch.all(torch.abs(y2 - y3) < 1e-5))  # tensor(True)
 
 
+def _group_norm(x: Tensor, num_groups: int, weight: Tensor = None, bias: Tensor = None,
+                eps: float = 1e-5) -> Tensor:
+    """(F.group_norm()). 对每个样本的每组通道(C // G, *)做归一化
+
+    :param x: shape = (N, C, *)
+    :param num_groups: G. C需被G整除
+    :param weight: shape = (C,)
+    :param bias: shape = (C,)
+    :param eps:
+    :return: shape = x.shape"""
+    N, C = x.shape[:2]
+    x_g = x.reshape(N, num_groups, -1)  # 每组的元素在最后一维上连续
+    # 一次遍历(torch.var_mean). x作为总体
+    var, mean = torch.var_mean(x_g, -1, unbiased=False, keepdim=True)
+    x = ((x_g - mean) * torch.rsqrt(var + eps)).view(x.shape)
+    shape = (C,) + (1,) * (x.dim() - 2)  # 与(N, C, *)的C对齐
+    if weight is not None and bias is not None:
+        return torch.addcmul(bias.view(shape), x, weight.view(shape))  # 一个kernel
+    return x * (weight.view(shape) if weight is not None else 1.) + (bias.view(shape) if bias is not None else 0.)
+
+
+# x = torch.randn(16, 32, 7, 7)
+# weight, bias = torch.randn(32), torch.randn(32)
+# y1 = F.group_norm(x, 8, weight, bias)
+# y2 = _group_norm(x, 8, weight, bias)
+# print(torch.allclose(y1, y2, atol=1e-5))
+
+
 def _dropout(x: Tensor, drop_p: float, training: bool) -> Tensor:
     """(F.dropout(inplace=False)).
 
@@ -270,11 +489,13 @@ def _dropout(x: Tensor, drop_p: float, training: bool) -> Tensor:
     :return: shape = x.shape"""
     if not training or not drop_p:
         return x
+    if drop_p == 1:  # 全部丢弃. 防止1 / keep_p除0(inf * 0 = nan)
+        return torch.zeros_like(x)
 
     keep_p = 1 - drop_p
-    keep_tensors = torch.floor(keep_p + torch.rand_like(x))
-    x = x * keep_tensors
-    return x / keep_p  # 保持均值不变
+    # 以keep_p的概率为1. 原地生成, 不额外分配rand张量; 缩放(保持均值不变)原地并入mask, 只对x做一次乘法
+    mask = torch.empty_like(x).bernoulli_(keep_p).div_(keep_p)
+    return x * mask
 
 
 # import torch
@@ -295,13 +516,28 @@ def _zero_padding2d(x: Tensor, padding: int) -> Tensor:
     :param x: shape = (N, C, Hin, Win)
     :param padding: int
     :return: shape = (N, C, Hout, Wout)"""
+    if not padding:
+        return x
+    # 不先zeros()再拷贝(写两遍输出): 一次写入边框的0与中间的x
+    # 直接调用F.pad(mode="constant")底层的算子, 跳过F.pad中python层的模式分发
+    return torch.constant_pad_nd(x, (padding, padding, padding, padding), 0.)  # LRTB
 
-    output = torch.zeros((*x.shape[:2],  # N, C
-                          x.shape[-2] + 2 * padding,  # Hout
-                          x.shape[-1] + 2 * padding), dtype=x.dtype, device=x.device)  # Wout
-    h_out, w_out = output.shape[-2:]
-    output[:, :, padding:h_out - padding, padding:w_out - padding] = x
-    return output
+
+def _sliding_windows(x: Tensor, kernel_size: Tuple[int, int], stride: Tuple[int, int]) -> Tensor:
+    """滑动窗口的视图(x.unfold(2, KH, SH).unfold(3, KW, SW)). 不拷贝数据
+
+    :param x: shape = (N, C, Hin, Win)
+    :param kernel_size: Tuple[KH, KW]
+    :param stride: Tuple[SH, SW]
+    :return: shape = (N, C, Hout, Wout, KH, KW)"""
+    (KH, KW), (SH, SW) = kernel_size, stride
+    N, C, H, W = x.shape
+    # Out = (In - K) // S + 1
+    output_h, output_w = (H - KH) // SH + 1, (W - KW) // SW + 1
+    stride_n, stride_c, stride_h, stride_w = x.stride()
+    return x.as_strided((N, C, output_h, output_w, KH, KW),
+                        (stride_n, stride_c, stride_h * SH, stride_w * SW, stride_h, stride_w),
+                        x.storage_offset())
 
 
 def _max_pool2d(x: Tensor, kernel_size: int, stride: int = None, padding: int = 0,
@@ -315,24 +551,18 @@ def _max_pool2d(x: Tensor, kernel_size: int, stride: int = None, padding: int =
     :param return_indices: bool
     :return: shape = (N, C, Hout, Wout)"""
     stride = stride or kernel_size
-    # Out = (In + 2*P − K) // S + 1
-    # padding的0.不加入max()运算, 故如此设计
-    output_h, output_w = (x.shape[2] + 2 * padding - kernel_size) // stride + 1, \
-                         (x.shape[3] + 2 * padding - kernel_size) // stride + 1
-    output = torch.empty((*x.shape[:2], output_h, output_w),
-                         dtype=x.dtype, device=x.device)
-    indices = torch.empty_like(output, dtype=torch.int64, device=x.device)
-    for i in range(output.shape[2]):  # Hout
-        for j in range(output.shape[3]):  # # Wout
-            _h_start_o, _w_start_o = i * stride - padding, j * stride - padding
-            _h_start, _w_start = max(0, _h_start_o), max(0, _w_start_o)
-            _h_end, _w_end = min(x.shape[-2], _h_start_o + kernel_size), min(x.shape[-1], _w_start_o + kernel_size)
-            h_pos, w_pos = slice(_h_start, _h_end), slice(_w_start, _w_end)
-            output[:, :, i, j], indices[:, :, i, j] = torch.max(x[:, :, h_pos, w_pos].flatten(2), dim=-1)
-            indices[:, :, i, j] = (h_pos.start + indices[:, :, i, j] // (w_pos.stop - w_pos.start)) * x.shape[-2] + \
-                                  w_pos.start + indices[:, :, i, j] % (w_pos.stop - w_pos.start)
-
-    return (output, indices) if return_indices else output
+    in_w = x.shape[-1]
+    if padding:  # 填充-inf, 使padding不加入max()运算
+        x = F.pad(x, (padding, padding, padding, padding), value=float("-inf"))
+    windows = _sliding_windows(x, (kernel_size, kernel_size), (stride, stride))
+    if not return_indices:
+        return torch.amax(windows, dim=(-2, -1))
+    output, indices = torch.max(windows.flatten(-2), dim=-1)  # indices: 窗口内的索引
+    # 转为x(未填充)中的索引: h * Win + w
+    h_start = torch.arange(output.shape[2], device=x.device) * stride - padding
+    w_start = torch.arange(output.shape[3], device=x.device) * stride - padding
+    indices = (h_start[:, None] + indices // kernel_size) * in_w + w_start + indices % kernel_size
+    return output, indices
 
 
 def _max_unpool2d(x: Tensor, indices: Tensor,
@@ -351,9 +581,8 @@ def _max_unpool2d(x: Tensor, indices: Tensor,
                          stride * (x.shape[3] - 1) - 2 * padding + kernel_size
     output = torch.zeros((*x.shape[:2], output_h, output_w),
                          dtype=x.dtype, device=x.device)
-    for i in range(x.shape[2]):  # Hin
-        for j in range(x.shape[3]):  # # Win
-            output.flatten(2)[:, torch.arange(0, output.shape[1]), indices[:, :, i, j]] = x[:, :, i, j]
+    # indices为展平后(Hout * Wout)中的位置: 一次scatter_写入所有值. (output连续, flatten(2)为view)
+    output.flatten(2).scatter_(2, indices.flatten(2), x.flatten(2))
     return output
 
 
@@ -369,19 +598,8 @@ def _avg_pool2d(x: Tensor, kernel_size: int, stride: int = None, padding: int =
     stride = stride or kernel_size
     if padding:
         x = _zero_padding2d(x, padding)
-    # Out = (In + 2*P − K) // S + 1
-    output_h, output_w = (x.shape[2] - kernel_size) // stride + 1, \
-                         (x.shape[3] - kernel_size) // stride + 1
-    output = torch.empty((*x.shape[:2], output_h, output_w),
-                         dtype=x.dtype, device=x.device)
-    for i in range(output.shape[2]):  # Hout
-        for j in range(output.shape[3]):  # # Wout
-            h_start, w_start = i * stride, j * stride
-            h_pos, w_pos = slice(h_start, (h_start + kernel_size)), \
-                           slice(w_start, (w_start + kernel_size))
-
-            output[:, :, i, j] = torch.mean(x[:, :, h_pos, w_pos], dim=(-2, -1))
-    return output
+    windows = _sliding_windows(x, (kernel_size, kernel_size), (stride, stride))
+    return torch.mean(windows, dim=(-2, -1))
 
 
 # from torch.nn.functional import avg_pool2d, max_pool2d
@@ -394,47 +612,142 @@ def _avg_pool2d(x: Tensor, kernel_size: int, stride: int = None, padding: int =
 def _linear(x: Tensor, weight: Tensor, bias: Tensor = None) -> Tensor:
     """全连接层(F.linear())
 
-    :param x: shape = (N, In)
+    :param x: shape = (N, ..., In)
     :param weight: shape = (Out, In)
     :param bias: shape = (Out,)
-    :return: shape = (N, Out)"""
-
-    return x @ weight.t() + (bias if bias is not None else 0.)
+    :return: shape = (N, ..., Out)"""
+    # weight.t()只是view, 转置由GEMM内部处理, 不拷贝
+    if bias is None:
+        return x @ weight.t()
+    if x.dim() == 2:
+        # addmm: bias + x @ weight^T. 加bias融合在GEMM中(与F.linear对2D输入的实现相同), 不额外遍历输出
+        return torch.addmm(bias, x, weight.t())
+    # addmm只支持2D输入
+    return x @ weight.t() + bias
 
 
 # x = torch.randn(10, 20)
 # w = torch.randn(30, 20)
 # print(_linear(x, w))
+# x = torch.randn(10, 5, 20)
+# b = torch.randn(30)
+# print(torch.allclose(_linear(x, w, b), F.linear(x, w, b), atol=1e-6))
 
-def _conv2d(x: Tensor, weight: Tensor, bias: Tensor = None, stride: int = 1, padding: int = 0) -> Tensor:
-    """2d卷积(F.conv2d()). 点乘
+# im2col的工作区, 按(shape, dtype, device)复用. LRU: 最多保留_IM2COL_CACHE_SIZE个, 可调用_clear_im2col_cache()释放
+_IM2COL_CACHE: "OrderedDict[Tuple, Tensor]" = OrderedDict()
+_IM2COL_CACHE_SIZE = 4
+
+
+def _clear_im2col_cache() -> None:
+    """释放_im2col()的所有工作区"""
+    _IM2COL_CACHE.clear()
+
+
+def _im2col(x: Tensor, kernel_size: Tuple[int, int], stride: int = 1, dilation: int = 1,
+            reuse_workspace: bool = False, channels_last: bool = False) -> Tensor:
+    """将每个卷积窗口展开为一行. 最多在最后的reshape时拷贝一次.
+    能表示为view时(e.g. 1x1卷积核)不拷贝, 此时返回值可能不连续
+
+    :param x: shape = (N, Cin, Hin, Win)(已padding)
+    :param kernel_size: Tuple[KH, KW]
+    :param stride: int
+    :param dilation: int
+    :param reuse_workspace: 写入_IM2COL_CACHE中的工作区, 而不是每次分配新的张量.
+        返回值在下次相同shape的调用时会被覆盖, 所以只能在不需要反向传播(不保存cols)时使用.
+        inference_mode下不使用(其中创建的工作区为inference tensor, 之后在inference_mode外无法原地写入)
+    :param channels_last: 最后一维的顺序为(KH, KW, Cin), Cin在最内层. x为NHWC时按内存顺序连续读取.
+        与weight.permute(0, 2, 3, 1).reshape(Cout, -1)一致
+    :return: shape = (N, Hout, Wout, Cin*KH*KW). 默认最后一维的顺序为(Cin, KH, KW), 与weight.view(Cout, -1)一致
+    """
+    N, Cin = x.shape[:2]
+    KH, KW = kernel_size
+    # 膨胀卷积: 先取大小为D*(K-1)+1的窗口, 再每隔D取一个(view)
+    # (N, Cin, Hout, Wout, KH, KW)
+    cols = x.unfold(2, dilation * (KH - 1) + 1, stride).unfold(3, dilation * (KW - 1) + 1, stride)
+    cols = cols[..., ::dilation, ::dilation]
+    output_h, output_w = cols.shape[2:4]
+    if channels_last:  # (N, Hout, Wout, KH, KW, Cin)
+        cols = cols.permute(0, 2, 3, 4, 5, 1)
+    else:  # (N, Hout, Wout, Cin, KH, KW)
+        cols = cols.permute(0, 2, 3, 1, 4, 5)
+    shape = (N, output_h, output_w, Cin * KH * KW)
+    if not reuse_workspace or torch.is_inference_mode_enabled():
+        return cols.reshape(shape)
+    key = (shape, x.dtype, x.device)
+    workspace = _IM2COL_CACHE.pop(key, None)
+    if workspace is None:
+        workspace = torch.empty(shape, dtype=x.dtype, device=x.device)
+    _IM2COL_CACHE[key] = workspace  # 移到最后(最近使用)
+    if len(_IM2COL_CACHE) > _IM2COL_CACHE_SIZE:
+        _IM2COL_CACHE.popitem(last=False)  # 丢弃最久未使用的
+    workspace.view(cols.shape).copy_(cols)
+    return workspace
+
+
+@functools.lru_cache(maxsize=None)
+def _get_direct_conv2d(KH: int, KW: int) -> torch.jit.ScriptFunction:
+    """生成(并缓存)针对(KH, KW), stride=1展开的直接卷积. 无需im2col的临时张量
+
+    x展平为(N, Cin, Hin*Win)后, 第(i, j)个tap对应的输入即为偏移i*Win+j的切片(view, 不拷贝).
+    每个tap做一次矩阵乘: [Cout, Cin] @ [N, Cin, L] -> [N, Cout, L]. 每行末尾多算的KW-1列最后丢弃
+
+    :return: ScriptFunction(x, weight) -> output. x: shape = (N, Cin, Hin, Win)(已padding)"""
+    lines = ["def direct_conv2d(x: Tensor, weight: Tensor) -> Tensor:",
+             "    N, Cout, Win = x.shape[0], weight.shape[0], x.shape[3]",
+             "    Hout, Wout = x.shape[2] - %d + 1, Win - %d + 1" % (KH, KW),
+             "    L = (Hout - 1) * Win + Wout",
+             "    x = x.flatten(2)",
+             "    weight = weight.permute(2, 3, 0, 1)  # (KH, KW, Cout, Cin)",
+             "    output = weight[0, 0] @ x[:, :, :L]"]
+    for i in range(KH):
+        for j in range(KW):
+            if i == 0 and j == 0:
+                continue
+            offset = "%d * Win + %d" % (i, j)
+            lines.append("    output.add_(weight[%d, %d] @ x[:, :, %s:%s + L])" % (i, j, offset, offset))
+    lines += ["    output = torch.constant_pad_nd(output, [0, Hout * Win - L], 0.)",
+              "    return output.view(N, Cout, Hout, Win)[:, :, :, :Wout]"]
+    return torch.jit.CompilationUnit("\n".join(lines)).direct_conv2d
+
+
+def _conv2d(x: Tensor, weight: Tensor, bias: Tensor = None, stride: int = 1, padding: int = 0,
+            memory_format: torch.memory_format = torch.contiguous_format) -> Tensor:
+    """2d卷积(F.conv2d()). im2col + 矩阵乘
 
     :param x: shape = (N, Cin, Hin, Win)
     :param weight: shape = (Cout, Cin, KH, KW)
     :param bias: shape = (Cout,)
     :param stride: int
     :param padding: int
-    :return: shape = (N, Cout, Hout, Wout)
+    :param memory_format: x, weight的内存布局(逻辑shape不变).
+        torch.contiguous_format(默认): NCHW, 小卷积核(stride=1)时使用展开的直接卷积. 输出为连续的NCHW
+        torch.channels_last: NHWC, im2col + 矩阵乘时Cin在最内层(连续), 输出也为NHWC.
+            与channels_last的层相连时使用, 否则x, weight每次调用都需转换一次
+    :return: shape = (N, Cout, Hout, Wout). 内存布局为memory_format
     """
+    if x.dtype != weight.dtype:  # 防止torch内部隐式类型转换(拷贝)
+        raise ValueError("dtype error: x(%s) != weight(%s)" % (x.dtype, weight.dtype))
     if padding:
         x = _zero_padding2d(x, padding)
-    kernel_size = weight.shape[-2]
-    # Out = (In + 2*P − K) // S + 1
-    output_h, output_w = (x.shape[2] - kernel_size) // stride + 1, \
-                         (x.shape[3] - kernel_size) // stride + 1
-    output = torch.empty((x.shape[0], weight.shape[0], output_h, output_w),
-                         dtype=x.dtype, device=x.device)
-    for i in range(output.shape[2]):  # Hout
-        for j in range(output.shape[3]):  # Wout
-            h_start, w_start = i * stride, j * stride
-            h_pos, w_pos = slice(h_start, (h_start + kernel_size)), \
-                           slice(w_start, (w_start + kernel_size))
-
-            output[:, :, i, j] = torch.sum(
-                # N, Cout, Cin, KH, KW
-                x[:, None, :, h_pos, w_pos] * weight[None, :, :, :, :], dim=(-3, -2, -1))
-
-    return output + (bias[:, None, None] if bias is not None else 0)  # 后对齐
+    x = x.contiguous(memory_format=memory_format)
+    weight = weight.contiguous(memory_format=memory_format)
+    Cout, _, KH, KW = weight.shape
+    # 直接卷积需要将HW展平(NCHW), channels_last时走im2col
+    if stride == 1 and KH * KW <= 9 and memory_format == torch.contiguous_format:  # 常见的小卷积核(e.g. 3x3): 展开的直接卷积
+        output = _get_direct_conv2d(KH, KW)(x, weight)  # 最后一维为切片, 不连续
+        return output + bias[:, None, None] if bias is not None else output.contiguous()
+    # im2col: (N, Hout, Wout, Cin*KH*KW). 推理时(不需要梯度)复用工作区, 不再每次分配
+    requires_grad = torch.is_grad_enabled() and (x.requires_grad or weight.requires_grad)
+    channels_last = memory_format == torch.channels_last
+    cols = _im2col(x, (KH, KW), stride, reuse_workspace=not requires_grad, channels_last=channels_last)
+    if channels_last:  # (Cout, KH, KW, Cin). weight为channels_last, 所以是view
+        # [N, Hout, Wout, Cin*KH*KW] @ [Cin*KH*KW, Cout] -> [N, Hout, Wout, Cout]. permute后即为NHWC
+        output = (cols @ weight.permute(0, 2, 3, 1).reshape(Cout, -1).t()).permute(0, 3, 1, 2)
+    else:
+        # [Cout, Cin*KH*KW] @ [N, Cin*KH*KW, Hout*Wout] -> [N, Cout, Hout*Wout]. 直接得到连续的NCHW
+        N, output_h, output_w = cols.shape[:3]
+        output = (weight.reshape(Cout, -1) @ cols.flatten(1, 2).transpose(1, 2)).view(N, Cout, output_h, output_w)
+    return output + bias[:, None, None] if bias is not None else output  # 后对齐
 
 
 def _conv2d_2(x: Tensor, weight: Tensor, bias: Tensor = None, stride: int = 1, padding: int = 0) -> Tensor:
@@ -474,7 +787,7 @@ def _conv2d_2(x: Tensor, weight: Tensor, bias: Tensor = None, stride: int = 1, p
 # import time
 # t = time.time()
 # y1 = _conv2d(x, weight, bias, 1, 1)
-# print(time.time() - t)  # 3.287348508834839
+# print(time.time() - t)
 # t = time.time()
 # y2 = _conv2d_2(x, weight, bias, 1, 1)
 # print(time.time() - t)  # 0.16396212577819824
@@ -488,10 +801,10 @@ def _conv2d_2(x: Tensor, weight: Tensor, bias: Tensor = None, stride: int = 1, p
 def __conv2d(x: Tensor, weight: Tensor, bias: Tensor = None,
              stride: int = 1, padding: int = 0,
              dilation: int = 1, groups: int = 1) -> Tensor:
-    """2d卷积(F.conv2d()) - 复杂版. 点乘
+    """2d卷积(F.conv2d()) - 复杂版. im2col + 分组的批量矩阵乘
 
     :param x: shape = (N, Cin, Hin, Win)
-    :param weight: shape = (groups * G_Cout, G_Cin, KH, KW).  假设KH=KW
+    :param weight: shape = (groups * G_Cout, G_Cin, KH, KW)
     :param bias: shape = (Cout,)
     :param stride: int
     :param padding: int
@@ -502,26 +815,18 @@ def __conv2d(x: Tensor, weight: Tensor, bias: Tensor = None,
 
     if padding:
         x = _zero_padding2d(x, padding)
-    kernel_size = dilation * (weight.shape[-2] - 1) + 1
-
+    N = x.shape[0]
+    Cout, _, KH, KW = weight.shape
+    g_cout = Cout // groups
     # O = (I + 2*P - (D*(K-1)+1)) // S + 1
-    output_h, output_w = (x.shape[2] - kernel_size) // stride + 1, \
-                         (x.shape[3] - kernel_size) // stride + 1
-    output = torch.empty((x.shape[0], weight.shape[0], output_h, output_w),
-                         dtype=x.dtype, device=x.device)
-    for g in range(groups):
-        g_cout, g_cin = weight.shape[0] // groups, weight.shape[1]
-        cin_pos = slice(g_cin * g, g_cin * (g + 1))
-        cout_pos = slice(g_cout * g, g_cout * (g + 1))
-        for i in range(output.shape[2]):  # Hout
-            for j in range(output.shape[3]):  # # Wout
-                h_start, w_start = i * stride, j * stride
-                h_pos, w_pos = slice(h_start, (h_start + kernel_size), dilation), \
-                               slice(w_start, (w_start + kernel_size), dilation)
-                output[:, cout_pos, i, j] = torch.sum(
-                    # N, G_Cout, G_Cin, KH, KW
-                    x[:, None, cin_pos, h_pos, w_pos] * weight[None, cout_pos, :, :, :], dim=(-3, -2, -1))
-
+    # (N, Hout, Wout, Cin*KH*KW). 最后一维按组连续: (groups, G_Cin*KH*KW)
+    cols = _im2col(x, (KH, KW), stride, dilation)
+    output_h, output_w = cols.shape[1:3]
+    cols = cols.reshape(N, output_h * output_w, groups, -1).transpose(1, 2)  # (N, groups, Hout*Wout, G_Cin*KH*KW)
+    # 各组一起算: [N, groups, Hout*Wout, G_Cin*KH*KW] @ [groups, G_Cin*KH*KW, G_Cout]
+    #   -> [N, groups, Hout*Wout, G_Cout]
+    output = cols @ weight.reshape(groups, g_cout, -1).transpose(1, 2)
+    output = output.transpose(2, 3).reshape(N, Cout, output_h, output_w)
     return output + (bias[:, None, None] if bias is not None else 0)  # 后对齐
 
 
@@ -572,7 +877,7 @@ def __conv2d_2(x: Tensor, weight: Tensor, bias: Tensor = None,
 # import time
 # t = time.time()
 # y1 = __conv2d(x, weight, bias, 1, 1, 2, 4)
-# print(time.time() - t)  # 1.5747883319854736
+# print(time.time() - t)
 # t = time.time()
 # y2 = __conv2d_2(x, weight, bias, 1, 1, 2, 4)
 # print(time.time() - t)  # 0.2872316837310791
@@ -613,6 +918,35 @@ def _conv_transpose2d(x: Tensor, weight: Tensor, bias: Tensor = None,
     return output if padding == 0 else output[:, :, padding:-padding, padding:-padding]
 
 
+def _shape_cache(func):
+    """functools.lru_cache, 用于缓存只与形状有关的张量(调用方不可原地修改).
+    缓存的张量总在inference_mode外创建: 否则首次调用若在inference_mode中, 得到的inference tensor
+    在之后需要反向传播的调用中无法使用"""
+
+    @functools.lru_cache(maxsize=None)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with torch.inference_mode(False):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@_shape_cache
+def _get_nearest_axes(in_size: Tuple[int, int], size: Tuple[int, int],
+                      device: torch.device) -> Tuple[Tensor, Tensor]:
+    """_nearest_interpolate()的采样坐标
+
+    :param in_size: Tuple[Hin, Win]
+    :param size: Tuple[Hout, Wout]
+    :param device:
+    :return: Tuple(axis_h: shape[Hout], axis_w: shape[Wout]). torch.long"""
+    step_h, step_w = in_size[0] / size[0], in_size[1] / size[1]  # 步长
+    axis_h = torch.arange(0, in_size[0], step_h, device=device).long()  # h坐标轴 floor
+    axis_w = torch.arange(0, in_size[1], step_w, device=device).long()  # w坐标轴
+    return axis_h, axis_w
+
+
 def _nearest_interpolate(x: Tensor, size: Tuple[int, int] = None, scale_factor: float = None) -> Tensor:
     """最近邻插值(F.interpolate(mode="nearest")). 与torch实现相同，与cv实现是否相同未知
 
@@ -624,13 +958,40 @@ def _nearest_interpolate(x: Tensor, size: Tuple[int, int] = None, scale_factor:
     in_size = x.shape[-2:]
     if scale_factor:
         size = int(in_size[0] * scale_factor), int(in_size[1] * scale_factor)  # out_size
-    step_h, step_w = in_size[0] / size[0], in_size[1] / size[1]  # 步长
-    axis_h = torch.arange(0, in_size[0], step_h, device=x.device).long()  # h坐标轴 floor
-    axis_w = torch.arange(0, in_size[1], step_w, device=x.device).long()  # w坐标轴
-    grid_h, grid_w = torch.meshgrid(axis_h, axis_w)  # 生成网格
-    output = x[:, :, grid_h, grid_w]
+    axis_h, axis_w = _get_nearest_axes(tuple(in_size), tuple(size), x.device)
+    # 可分离: 先按h取行, 再按w取列. 无需生成(Hout, Wout)的网格
+    return x.index_select(2, axis_h).index_select(3, axis_w)
 
-    return output
+
+@_shape_cache
+def _get_bilinear_grid(in_size: Tuple[int, int], size: Tuple[int, int], align_corners: bool,
+                       dtype: torch.dtype, device: torch.device) -> Tensor:
+    """_bilinear_interpolate()的采样网格
+
+    :param in_size: Tuple[Hin, Win]
+    :param size: Tuple[Hout, Wout]
+    :param align_corners: 见_bilinear_interpolate()
+    :param dtype:
+    :param device:
+    :return: shape = (Hout, Wout, 2). F.grid_sample(align_corners=True)的归一化坐标"""
+    step_h, step_w = in_size[0] / size[0], in_size[1] / size[1]
+    if align_corners:  # 角像素的中心点对齐(保留角像素的值)
+        axis_h = torch.linspace(0, in_size[0] - 1, size[0], dtype=dtype, device=device)  # h坐标轴
+        axis_w = torch.linspace(0, in_size[1] - 1, size[1], dtype=dtype, device=device)  # w坐标轴
+    else:  # 角像素的角点对齐
+        axis_h = torch.linspace(-0.5 + step_h / 2, - 0.5 + in_size[0] - step_h / 2, size[0],
+                                dtype=dtype, device=device)
+        axis_w = torch.linspace(-0.5 + step_w / 2, - 0.5 + in_size[1] - step_w / 2, size[1],
+                                dtype=dtype, device=device)
+    # if not align_corners:  # 超过边界的值，插值使用边缘值填充
+    # 理论上align_corners == True时不需要截断，但是linespace会有误差，导致有时候过ceil()后索引时会越界，所以都加上
+    axis_h.clamp_(0, in_size[0] - 1)
+    axis_w.clamp_(0, in_size[1] - 1)
+    # 像素坐标 -> F.grid_sample的归一化坐标[-1, 1]. (align_corners=True: -1, 1对应首尾像素的中心)
+    axis_h = axis_h * (2 / max(in_size[0] - 1, 1)) - 1
+    axis_w = axis_w * (2 / max(in_size[1] - 1, 1)) - 1
+    # shape(Hout, Wout, 2). 最后一维为(x, y), 即(w, h)
+    return torch.stack(torch.broadcast_tensors(axis_w[None, :], axis_h[:, None]), -1)
 
 
 def _bilinear_interpolate(x: Tensor, size: Tuple[int, int] = None, scale_factor: float = None,
@@ -649,28 +1010,23 @@ def _bilinear_interpolate(x: Tensor, size: Tuple[int, int] = None, scale_factor:
     in_size = x.shape[-2:]
     if scale_factor:
         size = int(in_size[0] * scale_factor), int(in_size[1] * scale_factor)  # out_size
-    step_h, step_w = in_size[0] / size[0], in_size[1] / size[1]
-    if align_corners:  # 角像素的中心点对齐(保留角像素的值)
-        axis_h = torch.linspace(0, in_size[0] - 1, size[0], device=x.device)  # h坐标轴
-        axis_w = torch.linspace(0, in_size[1] - 1, size[1], device=x.device)  # w坐标轴
-    else:  # 角像素的角点对齐
-        axis_h = torch.linspace(-0.5 + step_h / 2, - 0.5 + in_size[0] - step_h / 2, size[0], device=x.device)
-        axis_w = torch.linspace(-0.5 + step_w / 2, - 0.5 + in_size[1] - step_w / 2, size[1], device=x.device)
-    grid_h, grid_w = torch.meshgrid(axis_h, axis_w)  # 生成网格
-    # if not align_corners:  # 超过边界的值，插值使用边缘值填充
-    # 理论上align_corners == True时不需要截断，但是linespace会有误差，导致有时候过ceil()后索引时会越界，所以都加上
-    grid_h.clamp_(0, in_size[0] - 1)
-    grid_w.clamp_(0, in_size[1] - 1)
-    # 以下6个张量都是2D的, shape(Hout * Wout, Hout * Wout)
-    grid_h_f, grid_w_f = grid_h.long(), grid_w.long()  # floor
-    grid_h_c, grid_w_c = grid_h.ceil().long(), grid_w.ceil().long()  # ceil
-    offset_h, offset_w = grid_h - grid_h_f.float(), grid_w - grid_w_f.float()  # 与floor的偏离量
-    # 左上角, 右上角, 左下角, 右下角
-    output = (1 - offset_h) * (1 - offset_w) * x[:, :, grid_h_f, grid_w_f] + \
-             (1 - offset_h) * offset_w * x[:, :, grid_h_f, grid_w_c] + \
-             offset_h * (1 - offset_w) * x[:, :, grid_h_c, grid_w_f] + \
-             offset_h * offset_w * x[:, :, grid_h_c, grid_w_c]
-    return output
+    grid = _get_bilinear_grid(tuple(in_size), tuple(size), align_corners, x.dtype, x.device)
+    # 4个邻点的取值与加权在一个kernel中完成. 网格对N广播(expand, 不拷贝)
+    return F.grid_sample(x, grid.expand(x.shape[0], -1, -1, -1), "bilinear", "border", align_corners=True)
+
+
+@_shape_cache
+def _adaptive_bounds(in_size: int, output_size: int, device: torch.device) -> Tuple[Tensor, Tensor]:
+    """自适应池化中每个区间的[start, end). 与torch相同: start = floor(i * In / Out), end = ceil((i + 1) * In / Out)
+
+    :param in_size: int
+    :param output_size: int
+    :param device:
+    :return: Tuple(start: shape[output_size], end: shape[output_size]). torch.long"""
+    # 用python int计算, 避免浮点误差
+    start = [i * in_size // output_size for i in range(output_size)]
+    end = [-(-(i + 1) * in_size // output_size) for i in range(output_size)]  # ceil
+    return torch.tensor(start, device=device), torch.tensor(end, device=device)
 
 
 def _adaptive_avg_pool2d(x: Tensor, output_size: int) -> Tensor:
@@ -679,18 +1035,23 @@ def _adaptive_avg_pool2d(x: Tensor, output_size: int) -> Tensor:
     :param x: shape = (N, Cin, Hin, Win)
     :param output_size: int. 简化
     :return: shape = (N, Cin, output_size, output_size)"""
+    in_h, in_w = x.shape[-2:]
+    if in_h % output_size == 0 and in_w % output_size == 0:  # 整除时即为普通的平均池化
+        kernel_size = in_h // output_size, in_w // output_size
+        return torch.mean(_sliding_windows(x, kernel_size, kernel_size), dim=(-2, -1))
+    # 积分图(前缀和): s[:, :, i, j] = sum(x[:, :, :i, :j]). 任一区间的和由其4个角得到
+    # 4角相减会放大前缀和的舍入误差(大数相减), 故用更高精度累加: float32 -> float64, 半精度 -> float32
+    acc_dtype = torch.float64 if x.dtype in (torch.float32, torch.float64) else torch.float32
+    s = F.pad(torch.cumsum(torch.cumsum(x, -2, dtype=acc_dtype), -1), (1, 0, 1, 0))  # shape(N, Cin, Hin + 1, Win + 1)
+    h_start, h_end = _adaptive_bounds(in_h, output_size, x.device)
+    w_start, w_end = _adaptive_bounds(in_w, output_size, x.device)
 
-    # 切成output_size[0]个区间
-    split_h = torch.linspace(0, x.shape[-2], output_size + 1)
-    split_w = torch.linspace(0, x.shape[-1], output_size + 1)
-    output = torch.empty((*x.shape[:-2], output_size, output_size), dtype=x.dtype, device=x.device)
+    def corner(h: Tensor, w: Tensor) -> Tensor:
+        return s.index_select(2, h).index_select(3, w)
 
-    for i in range(output.shape[-2]):
-        for j in range(output.shape[-1]):
-            pos_h = slice(split_h[i].int().item(), split_h[i + 1].ceil().int().item())
-            pos_w = slice(split_w[j].int().item(), split_w[j + 1].ceil().int().item())
-            output[:, :, i, j] = torch.mean(x[:, :, pos_h, pos_w], dim=(-2, -1))
-    return output
+    area = (h_end - h_start)[:, None] * (w_end - w_start)  # shape(output_size, output_size)
+    return (corner(h_end, w_end) - corner(h_start, w_end) -
+            corner(h_end, w_start) + corner(h_start, w_start)).div_(area).to(x.dtype)
 
 
 def _adaptive_max_pool2d(x: Tensor, output_size: int, return_indices: bool = False) -> Tensor:
@@ -700,21 +1061,29 @@ def _adaptive_max_pool2d(x: Tensor, output_size: int, return_indices: bool = Fal
     :param output_size: int. 简化
     :param return_indices: bool
     :return: shape = (N, Cin, output_size[0], output_size[1])"""
-
-    # 切成output_size[0]个区间
-    split_h = torch.linspace(0, x.shape[-2], output_size + 1)
-    split_w = torch.linspace(0, x.shape[-1], output_size + 1)
-    output = torch.empty((*x.shape[:-2], output_size, output_size), dtype=x.dtype, device=x.device)
-    indices = torch.empty_like(output, dtype=torch.int64, device=x.device)
-    for i in range(output.shape[-2]):
-        for j in range(output.shape[-1]):
-            # 后用ceil()是为了使每个格子都加入运算
-            h_pos = slice(split_h[i].int().item(), split_h[i + 1].ceil().int().item())
-            w_pos = slice(split_w[j].int().item(), split_w[j + 1].ceil().int().item())
-            output[:, :, i, j], indices[:, :, i, j] = torch.max(x[:, :, h_pos, w_pos].flatten(2), dim=-1)
-            indices[:, :, i, j] = (h_pos.start + indices[:, :, i, j] // (w_pos.stop - w_pos.start)) * x.shape[-2] + \
-                                  w_pos.start + indices[:, :, i, j] % (w_pos.stop - w_pos.start)
-    return (output, indices) if return_indices else output
+    in_h, in_w = x.shape[-2:]
+    if in_h % output_size == 0 and in_w % output_size == 0 and not return_indices:  # 即为普通的最大池化
+        kernel_size = in_h // output_size, in_w // output_size
+        return torch.amax(_sliding_windows(x, kernel_size, kernel_size), dim=(-2, -1))
+    # 各区间长度不同: 统一取为最大长度的上界ceil(In / Out) + 1(python int, 无需同步).
+    # 超出区间的索引截断为区间的最后一个元素: 重复元素不影响max, 无需mask
+    kh, kw = -(-in_h // output_size) + 1, -(-in_w // output_size) + 1
+    h_start, h_end = _adaptive_bounds(in_h, output_size, x.device)
+    w_start, w_end = _adaptive_bounds(in_w, output_size, x.device)
+    # shape(output_size, kh), (output_size, kw)
+    h_idx = torch.min(h_start[:, None] + torch.arange(kh, device=x.device), h_end[:, None] - 1)
+    w_idx = torch.min(w_start[:, None] + torch.arange(kw, device=x.device), w_end[:, None] - 1)
+    # (N, Cin, Hout * KH, Win) -> (N, Cin, Hout, KH, Wout, KW) -> (N, Cin, Hout, Wout, KH * KW)
+    windows = x.index_select(2, h_idx.flatten()).index_select(3, w_idx.flatten())
+    windows = windows.view(*x.shape[:2], output_size, kh, output_size, kw).transpose(3, 4).flatten(4)
+    if not return_indices:
+        return torch.amax(windows, -1)
+    output, indices = torch.max(windows, -1)
+    # 窗口内的索引 -> x中(h * Win + w)的索引. shape(Hout, Wout, KH * KW)
+    pos = (h_idx[:, None, :, None] * in_w + w_idx[None, :, None, :]).flatten(2)
+    indices = pos[torch.arange(output_size, device=x.device)[:, None],
+                  torch.arange(output_size, device=x.device), indices]
+    return output, indices
 
 
 def _rnn_tanh_cell(x: Tensor, hx: Tensor, w_ih: Tensor, w_hh: Tensor,
@@ -730,9 +1099,14 @@ def _rnn_tanh_cell(x: Tensor, hx: Tensor, w_ih: Tensor, w_hh: Tensor,
     :return: shape = (N, Out)"""
     # y_i / hx_i+1 = tanh(x_i @ w_ih^T + b_ih + hx_i @ w_hh^T + b_hh)
     if hx is None:
-        hx = torch.zeros(x.shape[0], w_ih.shape[0])  # w_ih.shape[0]: Out
-    return torch.tanh(x @ w_ih.t() + (b_ih if b_ih is not None else 0.) +
-                      hx @ w_hh.t() + (b_hh if b_hh is not None else 0.))
+        hx = torch.zeros(x.shape[0], w_ih.shape[0], dtype=x.dtype, device=x.device)  # w_ih.shape[0]: Out
+    # 两个bias先在(Out,)上相加, 再由addmm融合进矩阵乘: 不额外遍历(N, Out)的输出
+    if b_ih is not None and b_hh is not None:
+        bias = b_ih + b_hh
+    else:
+        bias = b_ih if b_ih is not None else b_hh
+    y = _linear(x, w_ih, bias)  # addmm(bias, x, w_ih^T)
+    return torch.tanh(torch.addmm(y, hx, w_hh.t()))
 
 
 def _rnn_tanh(x: Tensor, hx: Tensor, params: List[Tensor], has_biases: bool) \
@@ -751,8 +1125,12 @@ def _rnn_tanh(x: Tensor, hx: Tensor, params: List[Tensor], has_biases: bool) \
     y = []  # 一层的输出
     hx_l0 = hx[0]
     w_ih, w_hh, b_ih, b_hh = params if has_biases else (*params, None, None)
+    # x_i @ w_ih^T + b_ih + b_hh与hx无关: 提到循环外, 所有时间步一次矩阵乘. [L, N, In] @ [In, Out] -> [L, N, Out]
+    x = x @ w_ih.t() + (b_ih if b_ih is not None else 0.) + (b_hh if b_hh is not None else 0.)
+    w_hh_t = w_hh.t()
     for i in range(x.shape[0]):
-        hx_l0 = _rnn_tanh_cell(x[i], hx_l0, w_ih, w_hh, b_ih, b_hh)
+        # 循环内只剩hx_i @ w_hh^T. addmm: 矩阵乘与加法一个kernel
+        hx_l0 = torch.tanh(torch.addmm(x[i], hx_l0, w_hh_t))
         y.append(hx_l0)
     y = torch.stack(y)
     return y, y[-1][None]
@@ -825,6 +1203,50 @@ def __rnn_tanh(x: Tensor, hx: Tensor, params: List[Tensor], has_biases: bool, nu
 # print(torch.all(torch.abs(hn - hn2) < 1e-6))  # True
 
 
+# 矩阵乘之后的逐元素运算(包括加bias)使用torch.jit.script融合为一个kernel: 只读gates, c一次, 只写h_1, c_1一次
+@torch.jit.script
+def _lstm_gates(gates: Tensor, c: Tensor,
+                b_ih: Optional[Tensor] = None, b_hh: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+    """lstm_cell中矩阵乘之后的部分
+
+    :param gates: shape = (N, Ch * 4). (i, f, g, o). 未加bias
+    :param c: shape = (N, Ch)
+    :param b_ih: shape = (Ch * 4,)
+    :param b_hh: shape = (Ch * 4,)
+    :return: Tuple(h_1: shape[N, Ch], c_1: shape[N, Ch])"""
+    if b_ih is not None:
+        gates = gates + b_ih
+    if b_hh is not None:
+        gates = gates + b_hh
+    i, f, g, o = gates.chunk(4, 1)
+    c_1 = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+    h_1 = torch.sigmoid(o) * torch.tanh(c_1)
+    return h_1, c_1
+
+
+@torch.jit.script
+def _gru_gates(gi: Tensor, gh: Tensor, hx: Tensor,
+               b_ih: Optional[Tensor] = None, b_hh: Optional[Tensor] = None) -> Tensor:
+    """gru_cell中矩阵乘之后的部分
+
+    :param gi: shape = (N, Ch * 3). (r, z, n). 未加bias
+    :param gh: shape = (N, Ch * 3). 未加bias
+    :param hx: shape = (N, Ch)
+    :param b_ih: shape = (Ch * 3,)
+    :param b_hh: shape = (Ch * 3,)
+    :return: hx_1: shape = (N, Ch)"""
+    if b_ih is not None:
+        gi = gi + b_ih
+    if b_hh is not None:
+        gh = gh + b_hh
+    i_r, i_z, i_n = gi.chunk(3, 1)
+    h_r, h_z, h_n = gh.chunk(3, 1)
+    r = torch.sigmoid(i_r + h_r)
+    z = torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+    return (1 - z) * n + z * hx
+
+
 def _lstm_cell(x: Tensor, hx: Union[Tuple[Tensor, ...], List[Tensor]],
                w_ih: Tensor, w_hh: Tensor,
                b_ih: Tensor = None, b_hh: Tensor = None) -> Tuple[Tensor, Tensor]:
@@ -847,23 +1269,12 @@ def _lstm_cell(x: Tensor, hx: Union[Tuple[Tensor, ...], List[Tensor]],
     c_hide = w_ih.shape[0] // 4  # Ch(channels_hide)
     h, c = hx
     if h is None:
-        h = torch.zeros(x.shape[0], c_hide)  # weight[0].shape[0]: Ch
+        h = torch.zeros(x.shape[0], c_hide, dtype=x.dtype, device=x.device)
     if c is None:
-        c = torch.zeros(x.shape[0], c_hide)
-    i = torch.sigmoid(x @ w_ih[0:c_hide].t() + (b_ih[0:c_hide] if b_ih is not None else 0) +
-                      h @ w_hh[0:c_hide].t() + (b_hh[0:c_hide] if b_hh is not None else 0))
-    f = torch.sigmoid(
-        x @ w_ih[c_hide:c_hide * 2].t() + (b_ih[c_hide:c_hide * 2] if b_ih is not None else 0) +
-        h @ w_hh[c_hide:c_hide * 2].t() + (b_hh[c_hide:c_hide * 2] if b_hh is not None else 0))
-    g = torch.tanh(
-        x @ w_ih[c_hide * 2:c_hide * 3].t() + (b_ih[c_hide * 2:c_hide * 3] if b_ih is not None else 0) +
-        h @ w_hh[c_hide * 2:c_hide * 3].t() + (b_hh[c_hide * 2:c_hide * 3] if b_hh is not None else 0))
-    o = torch.sigmoid(
-        x @ w_ih[c_hide * 3:c_hide * 4].t() + (b_ih[c_hide * 3:c_hide * 4] if b_ih is not None else 0) +
-        h @ w_hh[c_hide * 3:c_hide * 4].t() + (b_hh[c_hide * 3:c_hide * 4] if b_hh is not None else 0))
-    c_1 = f * c + i * g
-    h_1 = o * torch.tanh(c_1)
-    return h_1, c_1
+        c = torch.zeros(x.shape[0], c_hide, dtype=x.dtype, device=x.device)
+    # 4个门一起算: 2次矩阵乘, 而不是8次. shape(N, Ch * 4)
+    gates = x @ w_ih.t() + h @ w_hh.t()
+    return _lstm_gates(gates, c, b_ih, b_hh)
 
 
 def _gru_cell(x: Tensor, hx: Tensor, w_ih: Tensor, w_hh: Tensor,
@@ -878,20 +1289,40 @@ def _gru_cell(x: Tensor, hx: Tensor, w_ih: Tensor, w_hh: Tensor,
     :param b_hh: shape = (Ch * 3,)
     :return: y/hx_1: shape = (N, Ch)
     """
-    c_hide = w_ih[0].shape[0] // 3  # Ch(channels_hide)
+    c_hide = w_ih.shape[0] // 3  # Ch(channels_hide)
     if hx is None:
-        hx = torch.zeros(x.shape[0], c_hide)  # weight[0].shape[0]: Ch
+        hx = torch.zeros(x.shape[0], c_hide, dtype=x.dtype, device=x.device)
 
     # r = sigmoid(x_i @ Wir^T + bir + h_i @ Whr^T + bhr)  
     # z = sigmoid(x_i @ Wiz^T + biz + h_i @ Whz^T + bhz)  
     # n = tanh(x_i @ Win^T + bin + r*(h_i @ Whn^T + bhn))  
     # y_i / h_i+1 = (1 − z) * n + z * h_i
-    r = torch.sigmoid(x @ w_ih[0:c_hide].t() + (b_ih[0:c_hide] if b_ih is not None else 0) +
-                      hx @ w_hh[0:c_hide].t() + (b_hh[0:c_hide] if b_hh is not None else 0))
-    z = torch.sigmoid(x @ w_ih[c_hide:c_hide * 2].t() + (b_ih[c_hide:c_hide * 2] if b_ih is not None else 0) +
-                      hx @ w_hh[c_hide:c_hide * 2].t() + (b_hh[c_hide:c_hide * 2] if b_hh is not None else 0))
-    n = torch.tanh(
-        x @ w_ih[c_hide * 2:c_hide * 3].t() + (b_ih[c_hide * 2:c_hide * 3] if b_ih is not None else 0) +
-        r * (hx @ w_hh[c_hide * 2:c_hide * 3].t() + (b_hh[c_hide * 2:c_hide * 3] if b_hh is not None else 0)))
-    y = (1 - z) * n + z * hx  # hx_1
-    return y
+    # 3个门一起算: 2次矩阵乘. shape(N, Ch * 3)
+    # n门中r只乘h_i的部分, 所以gi与gh要先分开再相加
+    gi = x @ w_ih.t()
+    gh = hx @ w_hh.t()
+    return _gru_gates(gi, gh, hx, b_ih, b_hh)
+
+
+# --------------------------------------------------- compile
+def _compile_all(**kwargs) -> None:
+    """用torch.compile(Inductor)编译本模块中自己实现的函数(原地替换), 融合逐元素运算与规约. 需要torch >= 2.0
+    已经被torch.jit.script的函数不再编译. 函数间通过全局名调用, 所以替换后内部调用的也是编译后的版本
+
+    :param kwargs: 传给torch.compile(). 默认dynamic=True
+    :return: None"""
+    if not hasattr(torch, "compile"):
+        raise RuntimeError("torch.compile requires torch >= 2.0")
+    kwargs.setdefault("dynamic", True)
+    g = globals()
+    for k, v in list(g.items()):
+        if not k.startswith("_") or v is _compile_all:
+            continue
+        # 只编译本模块定义的python函数. ScriptFunction, 已编译过的(_torchdynamo_orig_callable)跳过
+        if inspect.isfunction(v) and v.__module__ == __name__ and not hasattr(v, "_torchdynamo_orig_callable"):
+            g[k] = torch.compile(v, **kwargs)
+
+
+# _compile_all()
+# x = torch.randn(16, 10)
+# print(torch.allclose(_softmax(x, -1), torch.softmax(x, -1)))
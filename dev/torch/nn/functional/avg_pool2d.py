@@ -24,18 +24,11 @@ def avg_pool2d(input: Tensor, kernel_size: Tuple[int, int],
     x = input
     stride = stride or kernel_size
     #
-    N, Cin, H, W = x.shape
     (KH, KW), (SH, SW), (PH, PW) = kernel_size, stride, padding
-    Hout, Wout = (H + 2 * PH - KH) // SH + 1, \
-                 (W + 2 * PW - KW) // SW + 1
     #
     if PH != 0 or PW != 0:
         x = F.pad(x, (PW, PW, PH, PH))  # LRTB
-    #
-    output = torch.empty((N, Cin, Hout, Wout), dtype=x.dtype, device=x.device)
-    #
-    for i in range(Hout):
-        for j in range(Wout):
-            xij = x[:, :, i * SH:i * SH + KH, j * SW: j * SW + KW]
-            output[:, :, i, j] = torch.mean(xij, dim=(2, 3))  # Ot(N*Cin*KH*KW)
+    # 滑动窗口(view, 不拷贝): [N, Cin, Hout, Wout, KH, KW]
+    x = x.unfold(2, KH, SH).unfold(3, KW, SW)
+    output = torch.mean(x, dim=(-2, -1))  # 一次规约. Ot(N*Cin*KH*KW * Hout*Wout)
     return output
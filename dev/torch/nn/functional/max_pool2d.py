@@ -20,20 +20,11 @@ def max_pool2d(input: Tensor, kernel_size: Tuple[int, int],
     x = input
     stride = stride or kernel_size
     #
-    N, Cin, H, W = x.shape
     (KH, KW), (SH, SW), (PH, PW) = kernel_size, stride, padding
-    Hout, Wout = (H + 2 * PH - KH) // SH + 1, \
-                 (W + 2 * PW - KW) // SW + 1
     #
     if PH != 0 or PW != 0:
         x = F.pad(x, (PW, PW, PH, PH), value=-torch.inf)  # LRTB
-    #
-    output = torch.empty((N, Cin, Hout, Wout), dtype=x.dtype, device=x.device)
-    #
-    for i in range(Hout):
-        for j in range(Wout):
-            xij = x[:, :, i * SH:i * SH + KH, j * SW: j * SW + KW]
-            xij = xij.contiguous().view(N, Cin, KH * KW)
-            #
-            output[:, :, i, j] = torch.max(xij, dim=-1)[0]
+    # 滑动窗口(view, 不拷贝): [N, Cin, Hout, Wout, KH, KW]
+    x = x.unfold(2, KH, SH).unfold(3, KW, SW)
+    output = torch.amax(x, dim=(-2, -1))  # 一次规约
     return output
@@ -9,6 +9,5 @@ from torch import Tensor
 def relu(input: Tensor) -> Tensor:
     """inplace=False"""
     x = input
-    #
-    zero = torch.tensor(0., dtype=x.dtype, device=x.device)
-    return torch.where(x > 0, x, zero)
+    # 标量0不需要每次创建张量(GPU上torch.tensor()需要一次host->device拷贝)
+    return torch.clamp_min(x, 0.)